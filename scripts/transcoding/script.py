@@ -7,288 +7,550 @@ extracts subtitles as separate SRT files, and transfers them to a remote destina
 """
 
 import argparse
+import contextlib
+import functools
+import json
 import os
+import queue
+import shlex
+import shutil
+import socket
 import subprocess
 import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 import paramiko
 import time
 import re
 import getpass
+import itertools
 
-def find_video_files(source_folder):
-    """Find all video files in the source folder."""
-    video_extensions = [
-        '.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm', 
-        '.m4v', '.mpg', '.mpeg', '.3gp', '.ts'
+VIDEO_EXTENSIONS = frozenset({
+    '.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm',
+    '.m4v', '.mpg', '.mpeg', '.3gp', '.ts'
+})
+
+# Uploads running alongside the transcodes
+TRANSFER_WORKERS = 2
+
+# libx264 threads per encode; past this x264 scales poorly, so bigger
+# machines run several CPU encodes side by side instead
+X264_THREADS = 8
+
+# NVDEC decoders for source codecs the GPU can decode
+CUVID_DECODERS = {
+    'h264': 'h264_cuvid',
+    'hevc': 'hevc_cuvid',
+    'vp9': 'vp9_cuvid',
+    'mpeg2video': 'mpeg2_cuvid'
+}
+
+# NVENC options for GPUs with little VRAM: few input surfaces, no
+# lookahead or B-frames to buffer, and frames handed out immediately
+NVENC_LOWMEM_ARGS = [
+    '-surfaces', '8',
+    '-delay', '0',
+    '-no-scenecut', '1',
+    '-rc-lookahead', '0',
+    '-bf', '0'
+]
+
+# Text subtitle formats ffmpeg can convert to SRT. Anything else (bitmap
+# formats like PGS, DVB or DVD subtitles, teletext, ARIB captions) would
+# fail the whole encode if it were written in the same pass.
+TEXT_SUBTITLE_CODECS = frozenset({
+    'subrip', 'srt', 'ass', 'ssa', 'mov_text', 'webvtt', 'text',
+    'microdvd', 'subviewer', 'subviewer1', 'sami', 'realtext',
+    'jacosub', 'mpl2', 'pjs', 'stl', 'vplayer'
+})
+
+# Options for every ssh/scp call: prefer AES-GCM (hardware accelerated on
+# modern CPUs), skip compression of already-compressed video and mark the
+# traffic as bulk
+SSH_OPTIONS = [
+    '-c', 'aes128-gcm@openssh.com,aes256-gcm@openssh.com,aes128-ctr',
+    '-o', 'Compression=no',
+    '-o', 'IPQoS=throughput'
+]
+if os.name != 'nt':
+    # Multiplex every ssh/scp call over one connection so each file doesn't
+    # pay for a new handshake (not supported by Windows OpenSSH). The socket
+    # lives in the user's own ~/.ssh and %C hashes the local user, host, port
+    # and remote user into a short fixed-length name.
+    SSH_OPTIONS += [
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath=~/.ssh/transcode-%C',
+        '-o', 'ControlPersist=60'
     ]
+
+# SSH channel window and packet size for SFTP, large enough to keep many
+# pipelined writes in flight on high-latency links
+SFTP_WINDOW_SIZE = 2**30
+SFTP_MAX_PACKET_SIZE = 2**19
+
+# Bytes read from the local file per SFTP write
+SFTP_BLOCK_SIZE = 2**20
+
+def find_video_files(source_folder, exclude_dir=None):
+    """Yield all video files in the source folder, walking the tree once.
     
-    video_files = []
-    for ext in video_extensions:
-        video_files.extend(Path(source_folder).glob(f"**/*{ext}"))
+    exclude_dir (e.g. a temp folder inside the source) is not descended into.
+    """
+    # Identify the excluded folder by device and inode, resolved once. Only
+    # subdirectories with its name are stat'ed to see if they are it.
+    exclude_name = exclude_id = None
+    if exclude_dir and os.path.isdir(exclude_dir):
+        exclude_name = os.path.basename(os.path.realpath(exclude_dir))
+        st = os.stat(exclude_dir)
+        exclude_id = (st.st_dev, st.st_ino)
     
-    return video_files
+    for root, dirs, files in os.walk(source_folder):
+        if exclude_id and exclude_name in dirs:
+            st = os.stat(os.path.join(root, exclude_name))
+            if (st.st_dev, st.st_ino) == exclude_id:
+                dirs.remove(exclude_name)
+        # Walk in a stable order so runs process files predictably
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in VIDEO_EXTENSIONS:
+                yield Path(root) / name
 
-def has_subtitles(video_path):
-    """Check if video has subtitle streams using ffprobe."""
+def probe_file(video_path):
+    """Probe all streams and the container of a video with a single ffprobe call."""
     cmd = [
-        'ffprobe', 
-        '-v', 'error', 
-        '-select_streams', 's', 
-        '-show_entries', 'stream=index', 
-        '-of', 'csv=p=0', 
+        'ffprobe',
+        '-v', 'error',
+        '-show_streams',
+        '-show_format',
+        '-of', 'json',
         str(video_path)
     ]
     
     result = subprocess.run(cmd, capture_output=True, text=True)
-    return result.stdout.strip() != ''
+    try:
+        probe = json.loads(result.stdout)
+    except ValueError:
+        print(f"Warning: Could not probe {video_path}: {result.stderr.strip()}")
+        probe = {}
+    probe.setdefault('streams', [])
+    probe.setdefault('format', {})
+    return probe
 
-def extract_subtitles(video_path, output_path):
-    """Extract subtitles from video to SRT file."""
+def _streams(probe, codec_type):
+    """Return the probed streams of one type ('video', 'audio', 'subtitle')."""
+    return [s for s in probe['streams'] if s.get('codec_type') == codec_type]
+
+def has_subtitles(video_path, probe=None):
+    """Check if video has subtitle streams."""
+    if probe is None:
+        probe = probe_file(video_path)
+    return bool(_streams(probe, 'subtitle'))
+
+class StreamTransferError(Exception):
+    """The command receiving a streamed transcode (e.g. ssh) failed."""
+
+def _run_ffmpeg(cmd, sink_cmd=None):
+    """Run an ffmpeg command, piping its stdout into sink_cmd if given.
     
-    # First, check what type of subtitles we're dealing with
-    subtitle_info_cmd = [
-        'ffprobe',
-        '-v', 'error',
-        '-select_streams', 's:0',
-        '-show_entries', 'stream=codec_name',
-        '-of', 'csv=p=0',
-        str(video_path)
-    ]
+    Raises CalledProcessError if ffmpeg fails, or StreamTransferError if the
+    sink does. The sink is checked first: when it dies ffmpeg fails too, on
+    the broken pipe, and that mustn't look like an encoder failure.
+    """
+    if sink_cmd is None:
+        subprocess.run(cmd, check=True)
+        return
     
-    result = subprocess.run(subtitle_info_cmd, capture_output=True, text=True)
-    subtitle_codec = result.stdout.strip()
+    ffmpeg = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        sink = subprocess.Popen(sink_cmd, stdin=ffmpeg.stdout)
+    except OSError:
+        ffmpeg.kill()
+        ffmpeg.wait()
+        raise
+    finally:
+        # Let the sink own the read end so ffmpeg sees SIGPIPE if it exits early
+        ffmpeg.stdout.close()
     
-    print(f"Detected subtitle codec: {subtitle_codec}")
+    ffmpeg.wait()
+    sink.wait()
+    if sink.returncode != 0:
+        raise StreamTransferError(f"{sink_cmd[0]} exited with status {sink.returncode}")
+    if ffmpeg.returncode != 0:
+        raise subprocess.CalledProcessError(ffmpeg.returncode, cmd)
+
+def transcode_video(video_path, output_path, bitrate='2M', use_gpu=False, preset='p4', probe=None, cpus=None,
+                    mkv_sink=None, lowmem=False):
+    """Transcode video to H.264+AAC MKV, plus an SRT of its first subtitle track.
     
-    # Ensure the output directory exists
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    GPU encodes run NVENC in single-pass constant-quality mode with the
+    bitrate as a ceiling; CPU encodes use libx264 CRF, limited to the given
+    list of CPU cores if cpus is set.
     
-    # Fix potential path issues by normalizing the path
-    srt_path = os.path.normpath(f"{output_path}.srt")
+    If mkv_sink is given, the MKV is piped into that command (e.g. an ssh
+    upload) instead of being written next to output_path. lowmem shrinks
+    NVENC's buffers for GPUs with little VRAM.
+    """
+    if probe is None:
+        probe = probe_file(video_path)
     
-    # Different approach based on subtitle format
-    if subtitle_codec in ['ass', 'ssa']:
-        # For ASS/SSA subtitles, extract to ASS first then convert
-        temp_ass_path = os.path.normpath(f"{output_path}.ass")
-        
-        try:
-            # Extract to ASS
-            ass_cmd = [
-                'ffmpeg',
-                '-i', str(video_path),
-                '-map', '0:s:0',
-                '-c:s', 'copy',
-                temp_ass_path
-            ]
-            subprocess.run(ass_cmd, check=True)
-            
-            # Convert ASS to SRT
-            srt_cmd = [
-                'ffmpeg',
-                '-i', temp_ass_path,
-                '-c:s', 'srt',
-                srt_path
-            ]
-            subprocess.run(srt_cmd, check=True)
-            
-            # Remove temporary ASS file
-            os.remove(temp_ass_path)
-            
-        except subprocess.CalledProcessError as e:
-            print(f"Warning: ASS/SSA subtitle extraction failed: {e}")
-            return False
+    # Regenerate missing timestamps on the way in, and mux with larger
+    # clusters on the way out. Index space isn't reserved up front: a fixed
+    # size that turns out too small for a long film or a keyframe-dense
+    # remux makes ffmpeg fail the whole output.
+    input_args = ['-fflags', '+genpts', '-i', str(video_path)]
+    mkv_output = [
+        '-f', 'matroska',
+        '-cluster_size_limit', '5M',
+        '-cluster_time_limit', '5000',
+        f"{output_path}.mkv" if mkv_sink is None else 'pipe:1'
+    ]
     
-    elif subtitle_codec in ['dvd_subtitle', 'dvdsub', 'hdmv_pgs_subtitle', 'pgssub']:
-        print("Warning: Image-based subtitles detected. OCR conversion required.")
-        try:
-            # Use OCR to extract subtitles from image-based formats
-            ocr_cmd = [
-                'ffmpeg',
-                '-i', str(video_path),
-                '-map', '0:s:0',
-                '-c:s', 'srt',
-                srt_path
-            ]
-            subprocess.run(ocr_cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Warning: Image-based subtitle extraction failed: {e}")
-            return False
+    # Check if video is 10-bit
+    video_streams = _streams(probe, 'video')
+    vstream = video_streams[0] if video_streams else {}
+    is_10bit = vstream.get('bits_per_raw_sample') == '10' or 'p10' in vstream.get('pix_fmt', '')
+    if is_10bit:
+        print(f"Detected 10-bit content: {video_path}")
     
-    else:
-        # Standard extraction for text-based subtitles
-        try:
-            cmd = [
-                'ffmpeg',
-                '-i', str(video_path),
-                '-map', '0:s:0',
-                '-c:s', 'srt',
-                srt_path
-            ]
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Warning: Failed to extract subtitles: {e}")
-            return False
-    
-    return os.path.exists(srt_path)
-
-def transcode_video(video_path, output_path, bitrate='2M', use_gpu=False):
-    """Transcode video to H.264+AAC MKV."""
+    # Write the first subtitle track to SRT in the same pass, so the source
+    # is only demuxed once
+    subtitle_args = []
+    if has_subtitles(video_path, probe):
+        subtitle_codec = _streams(probe, 'subtitle')[0].get('codec_name', '')
+        if subtitle_codec not in TEXT_SUBTITLE_CODECS:
+            print(f"Warning: {subtitle_codec} subtitles can't be converted to SRT, skipping them")
+        else:
+            subtitle_args = ['-map', '0:s:0', '-c:s', 'srt', f"{output_path}.srt"]
     
-    # Check if video is 10-bit (using ffprobe)
-    is_10bit = False
-    try:
+    # Sources that are already 8-bit H.264 + AAC only need remuxing into MKV
+    audio_codecs = {a.get('codec_name') for a in _streams(probe, 'audio')}
+    if vstream.get('codec_name') == 'h264' and not is_10bit and audio_codecs == {'aac'}:
+        print("Source is already H.264+AAC, remuxing without re-encoding")
         cmd = [
-            'ffprobe', 
-            '-v', 'error', 
-            '-select_streams', 'v:0', 
-            '-show_entries', 'stream=bits_per_raw_sample,pix_fmt', 
-            '-of', 'csv=p=0', 
-            str(video_path)
+            'ffmpeg',
+            '-nostdin',
+            '-y',
+            *input_args,
+            '-c', 'copy',
+            '-map', '0:v',
+            '-map', '0:a',
+            *mkv_output,
+            *subtitle_args
         ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        output = result.stdout.strip()
-        is_10bit = '10' in output or 'p10' in output
-        if is_10bit:
-            print(f"Detected 10-bit content: {video_path}")
-    except Exception as e:
-        print(f"Warning: Could not determine bit depth: {e}")
+        _run_ffmpeg(cmd, mkv_sink)
+        return
     
     if use_gpu:
-        # GPU-accelerated encoding with NVIDIA
+        # GPU-accelerated encoding with NVIDIA. Decode on NVDEC and keep the
+        # decoded frames in CUDA memory so they never round-trip through
+        # system RAM on their way to NVENC.
         cmd = [
             'ffmpeg',
-            '-i', str(video_path)
+            '-nostdin',
+            '-y',
+            '-hwaccel', 'cuda',
+            '-hwaccel_output_format', 'cuda'
         ]
         
-        # If 10-bit source, add pixel format conversion for NVENC
+        # Force the NVDEC (cuvid) decoder where there is one for this codec.
+        # Only the first video stream: attached cover art (MJPEG/PNG) would
+        # otherwise be handed to a decoder that can't read it.
+        decoder = CUVID_DECODERS.get(vstream.get('codec_name'))
+        if decoder:
+            cmd.extend(['-c:v:0', decoder])
+        cmd.extend(input_args)
+        
+        # If 10-bit source, convert on the GPU for NVENC compatibility
         if is_10bit:
             print("Converting 10-bit content for NVENC compatibility")
-            cmd.extend(['-pix_fmt', 'yuv420p'])
+            cmd.extend(['-vf', 'scale_cuda=format=yuv420p'])
             
-        cmd.extend([
+        nvenc_args = [
             '-c:v', 'h264_nvenc',
-            '-preset', 'p4',
+            '-preset', preset,
             '-profile:v', 'high',
-            '-b:v', bitrate,
+            '-rc', 'vbr',
+            '-cq', '23',
+            '-b:v', '0',
+            '-maxrate', bitrate,
+            '-bufsize', '4M',
+            *(NVENC_LOWMEM_ARGS if lowmem else []),
             '-c:a', 'aac',
             '-b:a', '192k',
             '-map', '0:v',
             '-map', '0:a',
-            f"{output_path}.mkv"
-        ])
+            *mkv_output,
+            *subtitle_args
+        ]
+        cmd.extend(nvenc_args)
         
         try:
-            subprocess.run(cmd, check=True)
+            _run_ffmpeg(cmd, mkv_sink)
             print("GPU encoding completed successfully")
             
         except subprocess.CalledProcessError as e:
             print(f"GPU encoding failed: {e}")
-            print("Falling back to CPU encoding...")
+            print("Retrying with frames copied back to system memory...")
+            
+            # Some filters/drivers can't work on CUDA frames, so retry with
+            # the generic hardware decode path and let ffmpeg hand NVENC
+            # system frames
+            retry_cmd = [
+                'ffmpeg',
+                '-nostdin',
+                '-y',
+                '-hwaccel', 'cuda',
+                *input_args
+            ]
+            if is_10bit:
+                retry_cmd.extend(['-pix_fmt', 'yuv420p'])
+            retry_cmd.extend(nvenc_args)
+            
+            try:
+                _run_ffmpeg(retry_cmd, mkv_sink)
+                print("GPU encoding completed successfully")
+                return
+            except subprocess.CalledProcessError as e:
+                print(f"GPU encoding failed: {e}")
+                print("Falling back to CPU encoding...")
             
             # CPU encoding fallback
             cpu_cmd = [
                 'ffmpeg',
-                '-i', str(video_path),
+                '-nostdin',
+                '-y',
+                *input_args,
                 '-c:v', 'libx264',
                 '-preset', 'medium',
                 '-crf', '22',
-                '-b:v', bitrate,
                 '-c:a', 'aac',
                 '-b:a', '192k',
                 '-map', '0:v',
                 '-map', '0:a',
-                f"{output_path}.mkv"
+                *mkv_output,
+                *subtitle_args
             ]
-            subprocess.run(cpu_cmd, check=True)
+            _run_ffmpeg(cpu_cmd, mkv_sink)
     else:
         # CPU encoding (original)
         cmd = [
             'ffmpeg',
-            '-i', str(video_path),
+            '-nostdin',
+            '-y',
+            *input_args,
             '-c:v', 'libx264',
             '-preset', 'medium',
-            '-crf', '22',
-            '-b:v', bitrate,
+            '-crf', '22'
+        ]
+        
+        # When sharing the machine with other encodes, stay on our own cores
+        if cpus:
+            cmd.extend(['-threads', str(len(cpus))])
+            if shutil.which('taskset'):
+                cmd[:0] = ['taskset', '-c', ','.join(map(str, cpus))]
+        
+        cmd.extend([
             '-c:a', 'aac',
             '-b:a', '192k',
             '-map', '0:v',
             '-map', '0:a',
-            f"{output_path}.mkv"
-        ]
-        subprocess.run(cmd, check=True)
+            *mkv_output,
+            *subtitle_args
+        ])
+        _run_ffmpeg(cmd, mkv_sink)
     
 
-def create_remote_dir(sftp, remote_path):
-    """Create remote directory and all parent directories if they don't exist."""
+def create_remote_dir(sftp, remote_path, known_dirs=None):
+    """Create remote directory and all parent directories if they don't exist.
+    
+    Directories in known_dirs are taken as existing without a stat call.
+    """
     if remote_path == '/' or remote_path == '':
         return
+    if known_dirs is not None and remote_path in known_dirs:
+        return
     
     try:
         sftp.stat(remote_path)
     except IOError:
         parent = os.path.dirname(remote_path)
-        create_remote_dir(sftp, parent)
+        create_remote_dir(sftp, parent, known_dirs)
         try:
             sftp.mkdir(remote_path)
         except IOError:
             # Directory might have been created by another process
             pass
 
-def transfer_file(local_path, remote_host, remote_path, username=None, password=None, transfer_method='sftp'):
-    """Transfer file to remote host using SFTP or SCP."""
+def _open_socket(remote_host, port=22):
+    """Connect a TCP socket for the SSH transport.
+    
+    Every address the host resolves to is tried in turn, like paramiko does.
+    Nagle is disabled so the small SFTP acknowledgements aren't held back.
+    Kernel buffer sizes are left to the OS, which autotunes them upwards.
+    """
+    sock = socket.create_connection((remote_host, port))
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+@functools.lru_cache(maxsize=None)
+def _load_private_key(key_path):
+    """Load an SSH private key, once per run, using the type its file name implies."""
+    key_name = os.path.basename(key_path)
+    if 'ed25519' in key_name:
+        key_class = paramiko.Ed25519Key
+    elif 'ecdsa' in key_name:
+        key_class = paramiko.ECDSAKey
+    else:
+        key_class = paramiko.RSAKey
+    return key_class.from_private_key_file(key_path)
+
+class RemoteSession:
+    """SFTP connection to the remote host, shared by every transfer in a run.
+    
+    The SSH transport is opened and authenticated once; each thread gets its
+    own SFTP channel on top of it. Remote directories that are known to exist
+    are cached so repeat uploads into the same folder skip creating them.
+    """
+    
+    def __init__(self, remote_host, username=None, password=None):
+        self.remote_host = remote_host
+        self.username = username or os.getlogin()
+        self.password = password
+        self.transport = None
+        self._local = threading.local()
+        self._sftp_clients = []
+        self._created_dirs = set()
+    
+    def __enter__(self):
+        self.transport = paramiko.Transport(_open_socket(self.remote_host))
+        try:
+            self._authenticate()
+            # Keep the idle connection alive through hours-long transcodes
+            self.transport.set_keepalive(30)
+            self.sftp  # open the calling thread's channel up front
+        except Exception:
+            self.transport.close()
+            raise
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        for sftp in self._sftp_clients:
+            sftp.close()
+        self.transport.close()
+    
+    def _authenticate(self):
+        """Try authentication methods in order."""
+        username, remote_host, transport = self.username, self.remote_host, self.transport
+        # Negotiate the session once; each auth attempt below reuses it
+        transport.start_client()
+        if self.password:
+            try:
+                print(f"Attempting password authentication for {username}@{remote_host}")
+                transport.auth_password(username, self.password)
+            except paramiko.SSHException as e:
+                print(f"Password authentication failed: {e}")
+                raise
+        else:
+            # Try to use SSH key authentication
+            print(f"Attempting key-based authentication for {username}@{remote_host}")
+            key_paths = [
+                os.path.expanduser('~/.ssh/id_rsa'),
+                os.path.expanduser('~/.ssh/id_ed25519'),
+                os.path.expanduser('~/.ssh/id_ecdsa')
+            ]
+            
+            for key_path in key_paths:
+                if os.path.exists(key_path):
+                    try:
+                        key = _load_private_key(key_path)
+                        transport.auth_publickey(username, key)
+                        print(f"Key authentication successful using {key_path}")
+                        break
+                    except Exception as e:
+                        print(f"Failed to authenticate with key {key_path}: {e}")
+                else:
+                    print(f"Key file not found: {key_path}")
+            
+            # If we got here and transport isn't authenticated, all auth methods failed
+            if not transport.is_authenticated():
+                raise paramiko.SSHException("All authentication methods failed")
+    
+    @property
+    def sftp(self):
+        """SFTP client for the calling thread, opened on first use."""
+        sftp = getattr(self._local, 'sftp', None)
+        if sftp is None:
+            sftp = self._local.sftp = paramiko.SFTPClient.from_transport(
+                self.transport,
+                window_size=SFTP_WINDOW_SIZE,
+                max_packet_size=SFTP_MAX_PACKET_SIZE
+            )
+            self._sftp_clients.append(sftp)
+        return sftp
+    
+    def make_remote_dir(self, remote_dir):
+        """Create a remote directory and its parents, like `mkdir -p`.
+        
+        Folders created (or seen) earlier in the run are cached, so after the
+        first file in a tree most calls cost no round trips at all.
+        """
+        if remote_dir in self._created_dirs:
+            return
+        
+        create_remote_dir(self.sftp, remote_dir, self._created_dirs)
+        
+        # Every parent now exists as well
+        while remote_dir not in ('', '/') and remote_dir not in self._created_dirs:
+            self._created_dirs.add(remote_dir)
+            remote_dir = os.path.dirname(remote_dir)
+    
+    def transfer(self, local_path, remote_path):
+        """Upload a file, creating the remote directory if needed."""
+        sftp = self.sftp
+        self.make_remote_dir(os.path.dirname(remote_path))
+        
+        # Like sftp.put(), but with much larger reads than its fixed 32 KB.
+        # Both ends are unbuffered and every block is read into the same
+        # buffer, so data isn't copied around in Python on its way out. The
+        # size check put() does afterwards is skipped, it costs a round trip
+        # per file and a short write already raises.
+        buffer = bytearray(SFTP_BLOCK_SIZE)
+        view = memoryview(buffer)
+        with open(local_path, 'rb', buffering=0) as local_file, \
+                sftp.open(remote_path, 'wb', bufsize=0) as remote_file:
+            remote_file.set_pipelined(True)
+            while size := local_file.readinto(buffer):
+                remote_file.write(view[:size])
+
+@functools.lru_cache(maxsize=None)
+def _have_sshpass():
+    """Check once per run whether sshpass is on the PATH."""
+    return shutil.which('sshpass') is not None
+
+def transfer_file(local_path, remote_host, remote_path, username=None, password=None, transfer_method='scp', session=None):
+    """Transfer file to remote host using SCP or SFTP.
+    
+    SCP runs the system client, which is considerably faster than paramiko.
+    Pass an open RemoteSession to reuse its connection for SFTP transfers.
+    """
     if username is None:
         username = os.getlogin()
     
     if transfer_method == 'sftp':
         # Use paramiko for SFTP
-        transport = paramiko.Transport((remote_host, 22))
-        
         try:
-            # Try authentication methods in order
-            if password:
-                try:
-                    print(f"Attempting password authentication for {username}@{remote_host}")
-                    transport.connect(username=username, password=password)
-                except paramiko.SSHException as e:
-                    print(f"Password authentication failed: {e}")
-                    raise
+            if session is not None:
+                session.transfer(local_path, remote_path)
             else:
-                # Try to use SSH key authentication
-                print(f"Attempting key-based authentication for {username}@{remote_host}")
-                key_paths = [
-                    os.path.expanduser('~/.ssh/id_rsa'),
-                    os.path.expanduser('~/.ssh/id_ed25519')
-                ]
-                
-                for key_path in key_paths:
-                    if os.path.exists(key_path):
-                        try:
-                            key = paramiko.RSAKey.from_private_key_file(key_path)
-                            transport.connect(username=username, pkey=key)
-                            print(f"Key authentication successful using {key_path}")
-                            break
-                        except Exception as e:
-                            print(f"Failed to authenticate with key {key_path}: {e}")
-                    else:
-                        print(f"Key file not found: {key_path}")
-                
-                # If we got here and transport isn't active, all auth methods failed
-                if not transport.is_active():
-                    raise paramiko.SSHException("All authentication methods failed")
-                    
-            sftp = paramiko.SFTPClient.from_transport(transport)
-            
-            # Create remote directory if it doesn't exist
-            remote_dir = os.path.dirname(remote_path)
-            create_remote_dir(sftp, remote_dir)
-                
-            sftp.put(local_path, remote_path)
-            sftp.close()
-            transport.close()
+                with RemoteSession(remote_host, username, password) as session:
+                    session.transfer(local_path, remote_path)
             
         except Exception as e:
-            transport.close()
             print(f"SFTP transfer failed: {e}")
             print("Trying SCP instead...")
             
@@ -296,14 +558,14 @@ def transfer_file(local_path, remote_host, remote_path, username=None, password=
             try:
                 # First ensure remote directory exists
                 remote_dir = os.path.dirname(remote_path)
-                if password:
+                if password and _have_sshpass():
                     # Use sshpass if password is provided
-                    mkdir_cmd = ['sshpass', '-p', password, 'ssh', f"{username}@{remote_host}", f"mkdir -p '{remote_dir}'"]
-                    scp_cmd = ['sshpass', '-p', password, 'scp', local_path, f"{username}@{remote_host}:{remote_path}"]
+                    mkdir_cmd = ['sshpass', '-p', password, 'ssh', *SSH_OPTIONS, f"{username}@{remote_host}", f"mkdir -p '{remote_dir}'"]
+                    scp_cmd = ['sshpass', '-p', password, 'scp', *SSH_OPTIONS, local_path, f"{username}@{remote_host}:{remote_path}"]
                 else:
                     # Use regular ssh/scp with key auth
-                    mkdir_cmd = ['ssh', f"{username}@{remote_host}", f"mkdir -p '{remote_dir}'"]
-                    scp_cmd = ['scp', local_path, f"{username}@{remote_host}:{remote_path}"]
+                    mkdir_cmd = ['ssh', *SSH_OPTIONS, f"{username}@{remote_host}", f"mkdir -p '{remote_dir}'"]
+                    scp_cmd = ['scp', *SSH_OPTIONS, local_path, f"{username}@{remote_host}:{remote_path}"]
                 
                 subprocess.run(mkdir_cmd, check=True)
                 subprocess.run(scp_cmd, check=True)
@@ -317,22 +579,16 @@ def transfer_file(local_path, remote_host, remote_path, username=None, password=
             # First ensure remote directory exists
             remote_dir = os.path.dirname(remote_path)
             
-            if password:
-                # Check if sshpass is available
-                try:
-                    if os.name == 'nt':  # Windows
-                        check_cmd = ['where', 'sshpass']
-                    else:  # Unix/Linux/Mac
-                        check_cmd = ['which', 'sshpass']
-                    subprocess.run(check_cmd, check=True, capture_output=True)
-                except subprocess.CalledProcessError:
+            if password and _have_sshpass():
+                # Use sshpass if password is provided
+                mkdir_cmd = ['sshpass', '-p', password, 'ssh', *SSH_OPTIONS, f"{username}@{remote_host}", f"mkdir -p '{remote_dir}'"]
+                scp_cmd = ['sshpass', '-p', password, 'scp', *SSH_OPTIONS, local_path, f"{username}@{remote_host}:{remote_path}"]
+            else:
+                if password:
                     print("Warning: sshpass not found. Password authentication may not work with SCP.")
                     print("Try installing sshpass or using key-based authentication.")
-                    mkdir_cmd = ['ssh', f"{username}@{remote_host}", f"mkdir -p '{remote_dir}'"]
-                    scp_cmd = ['scp', local_path, f"{username}@{remote_host}:{remote_path}"]
-            else:
-                mkdir_cmd = ['ssh', f"{username}@{remote_host}", f"mkdir -p '{remote_dir}'"]
-                scp_cmd = ['scp', local_path, f"{username}@{remote_host}:{remote_path}"]
+                mkdir_cmd = ['ssh', *SSH_OPTIONS, f"{username}@{remote_host}", f"mkdir -p '{remote_dir}'"]
+                scp_cmd = ['scp', *SSH_OPTIONS, local_path, f"{username}@{remote_host}:{remote_path}"]
             
             subprocess.run(mkdir_cmd, check=True)
             subprocess.run(scp_cmd, check=True)
@@ -342,6 +598,202 @@ def transfer_file(local_path, remote_host, remote_path, username=None, password=
             return False
     
     return True
+
+def _ssh_command(remote_host, remote_cmd, username=None, password=None):
+    """Build an ssh command line running remote_cmd on the remote host.
+    
+    Without sshpass the command runs in batch mode, so it fails instead of
+    stopping an unattended run to prompt for a password.
+    """
+    if username is None:
+        username = os.getlogin()
+    
+    if password and _have_sshpass():
+        return ['sshpass', '-p', password, 'ssh', *SSH_OPTIONS, f"{username}@{remote_host}", remote_cmd]
+    return ['ssh', *SSH_OPTIONS, '-o', 'BatchMode=yes', f"{username}@{remote_host}", remote_cmd]
+
+def transfer_batch(local_paths, local_root, remote_host, remote_root, username=None, password=None):
+    """Transfer many small files as a single tar stream over one ssh connection.
+    
+    Files keep their paths relative to local_root, recreated under remote_root.
+    Returns True if the whole batch arrived.
+    """
+    remote_cmd = f"mkdir -p {shlex.quote(remote_root)} && tar -C {shlex.quote(remote_root)} -xf -"
+    ssh_cmd = _ssh_command(remote_host, remote_cmd, username, password)
+    
+    # File names go in on stdin, NUL-separated, so long batches don't hit
+    # command line length limits
+    names = b'\0'.join(os.fsencode(os.path.relpath(path, local_root)) for path in local_paths)
+    try:
+        tar = subprocess.Popen(['tar', '-C', str(local_root), '--null', '-cf', '-', '-T', '-'],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    except OSError as e:
+        print(f"Batch transfer failed: {e}")
+        return False
+    try:
+        ssh = subprocess.Popen(ssh_cmd, stdin=tar.stdout)
+    except OSError as e:
+        print(f"Batch transfer failed: {e}")
+        tar.kill()
+        tar.wait()
+        return False
+    finally:
+        # Let ssh own the read end so tar sees SIGPIPE if ssh exits early
+        tar.stdout.close()
+    
+    try:
+        tar.stdin.write(names)
+        tar.stdin.close()
+    except BrokenPipeError:
+        pass
+    
+    tar.wait()
+    ssh.wait()
+    if tar.returncode != 0 or ssh.returncode != 0:
+        print(f"Batch transfer failed: tar exited with {tar.returncode}, ssh with {ssh.returncode}")
+        return False
+    return True
+
+def _transcode_job(video_path, args, temp_dir, cpus=None):
+    """Transcode one video into the temp folder.
+    
+    With --stream the MKV goes straight to the remote host and mkv_path is
+    None. Returns (mkv_path, srt_path, remote_paths) for the transfer stage.
+    """
+    # Create output filename preserving directory structure
+    rel_path = video_path.relative_to(Path(args.source))
+    output_dir = temp_dir / rel_path.parent
+    output_path = output_dir / rel_path.stem
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    remote_base = f"{args.dest_folder}/{rel_path.parent/rel_path.stem}"
+    remote_paths = (f"{remote_base}.mkv", f"{remote_base}.srt")
+    
+    probe = probe_file(video_path)
+    
+    mkv_path = f"{output_path}.mkv"
+    mkv_sink = None
+    if args.stream:
+        # Skip the local temp file and write the MKV on the remote side
+        mkv_path = None
+        remote_cmd = (f"mkdir -p {shlex.quote(os.path.dirname(remote_paths[0]))}"
+                      f" && cat > {shlex.quote(remote_paths[0])}")
+        mkv_sink = _ssh_command(args.dest_host, remote_cmd, args.username, args.password)
+        print(f"Streaming {video_path} to {args.dest_host}:{remote_paths[0]}")
+    
+    print(f"Transcoding {video_path}...")
+    try:
+        transcode_video(video_path, output_path, args.bitrate, use_gpu=args.use_gpu, preset=args.preset,
+                        probe=probe, cpus=cpus, mkv_sink=mkv_sink, lowmem=args.lowmem)
+    except StreamTransferError as e:
+        # A transfer failure, not an encoder one: log it like the other
+        # transfers do and still send the subtitles
+        print(f"Streaming {video_path} to {args.dest_host}:{remote_paths[0]} failed: {e}")
+    
+    return mkv_path, f"{output_path}.srt", remote_paths
+
+def _transfer_job(payload, args, pending_srts, session=None):
+    """Upload a transcoded MKV, then remove the local copy.
+    
+    The SRT, if any, is added to pending_srts to be sent in one batch later.
+    A streamed MKV (mkv_path None) is already on the remote host.
+    """
+    mkv_path, srt_path, (remote_mkv_path, remote_srt_path) = payload
+    
+    if mkv_path is not None:
+        print(f"Transferring {mkv_path} to {args.dest_host}:{remote_mkv_path}")
+        transfer_file(mkv_path, args.dest_host, remote_mkv_path, args.username, args.password, args.method, session)
+    
+    if os.path.exists(srt_path):
+        pending_srts.append((srt_path, remote_srt_path))
+    
+    # Clean up temporary files
+    if mkv_path is not None and os.path.exists(mkv_path):
+        os.remove(mkv_path)
+
+def _transfer_subtitles(pending_srts, args, temp_dir, session=None):
+    """Upload the collected SRT files in one batch, then remove the local copies.
+    
+    With an open SFTP session the files go over that connection instead.
+    """
+    local_paths = [srt_path for srt_path, _ in pending_srts]
+    print(f"Transferring {len(local_paths)} subtitle files to {args.dest_host}:{args.dest_folder}")
+    if session is not None or not transfer_batch(local_paths, temp_dir, args.dest_host, args.dest_folder,
+                                                 args.username, args.password):
+        if session is None:
+            print("Batch transfer failed, sending subtitle files one at a time...")
+        for srt_path, remote_srt_path in pending_srts:
+            transfer_file(srt_path, args.dest_host, remote_srt_path, args.username, args.password, args.method, session)
+    
+    # Clean up temporary files
+    for srt_path in local_paths:
+        if os.path.exists(srt_path):
+            os.remove(srt_path)
+
+def _transfer_worker(transfer_queue, args, pending_srts, session=None):
+    """Consume transcoded files from the queue until a None sentinel arrives."""
+    while True:
+        payload = transfer_queue.get()
+        if payload is None:
+            return
+        try:
+            _transfer_job(payload, args, pending_srts, session)
+        except Exception as e:
+            print(f"Transfer of {payload[2][0]} failed: {e}")
+
+def _cpu_blocks():
+    """Split the usable CPU cores into blocks of X264_THREADS, one per encode."""
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    
+    count = len(cores) // X264_THREADS
+    if count < 2:
+        # Not enough cores to share, let a single encode use all of them
+        return [None]
+    return [cores[n * X264_THREADS:(n + 1) * X264_THREADS] for n in range(count)]
+
+def _transcode_stage(video_files, args, temp_dir, transfer_queue):
+    """Transcode the videos and queue the results for transfer.
+    
+    The GPU is a single resource, so NVENC encodes run one at a time. CPU
+    encodes run side by side, each pinned to its own block of cores.
+    A failed transcode is logged and skipped so the others carry on.
+    Returns the number of videos that failed.
+    """
+    free_cpus = [None] if args.use_gpu else _cpu_blocks()
+    running = {}
+    failures = 0
+    
+    def finish_one():
+        nonlocal failures
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        future = done.pop()
+        cpus, video_path = running.pop(future)
+        free_cpus.append(cpus)
+        try:
+            transfer_queue.put(future.result())
+        except Exception as e:
+            print(f"Transcoding {video_path} failed: {e}")
+            failures += 1
+    
+    try:
+        with ThreadPoolExecutor(max_workers=len(free_cpus)) as pool:
+            for i, video_path in enumerate(video_files, 1):
+                if not free_cpus:
+                    finish_one()
+                print(f"Processing file {i}: {video_path}")
+                cpus = free_cpus.pop()
+                running[pool.submit(_transcode_job, video_path, args, temp_dir, cpus)] = (cpus, video_path)
+            while running:
+                finish_one()
+        return failures
+    finally:
+        # Always release the transfer workers, even if a transcode failed
+        for _ in range(TRANSFER_WORKERS):
+            transfer_queue.put(None)
+
 def main():
         # Check if any arguments were provided
     if len(sys.argv) == 1:
@@ -355,13 +807,14 @@ def main():
             print("Invalid directory!")
             source = input("Enter source folder containing videos: ").strip()
         
-        # Get bitrate
-        bitrate = input("\nEnter video bitrate (leave blank for 2M): ").strip()
-        if not bitrate:
-            bitrate = "2M"
-        
          # Add GPU option
         use_gpu = input("\nUse NVIDIA GPU acceleration? (y/n, leave blank for no): ").lower().strip() == 'y'
+        lowmem = use_gpu and input("\nReduce NVENC memory use for small GPUs? (y/n, leave blank for no): ").lower().strip() == 'y'
+        
+        # Get bitrate cap (only NVENC uses it; CPU encodes are constant quality)
+        bitrate = "2M"
+        if use_gpu:
+            bitrate = input("\nEnter maximum video bitrate for GPU encoding (leave blank for 2M): ").strip() or "2M"
 
         # Get destination host
         dest_host = input("\nEnter destination host for file transfer: ").strip()
@@ -377,9 +830,13 @@ def main():
         username = input("\nEnter username for remote host (leave blank for current user): ").strip() or None
         password = getpass.getpass("\nEnter password for remote host (leave blank for SSH key auth): ") or None
         # Get transfer method
-        method = input("\nEnter transfer method (sftp/scp, leave blank for sftp): ").lower().strip()
+        method = input("\nEnter transfer method (scp/sftp, leave blank for scp): ").lower().strip()
         if not method or method not in ["sftp", "scp"]:
-            method = "sftp"
+            method = "scp"
+        
+        # Streaming option
+        print("\nStreamed MKVs skip the temp folder but have no seek index or duration.")
+        stream = input("Stream transcoded videos straight to the remote host over ssh? (y/n, leave blank for no): ").lower().strip() == 'y'
         
         # Get temp folder
         temp = input("\nEnter temporary folder for transcoded files (leave blank for /tmp/transcode): ").strip()
@@ -400,10 +857,14 @@ def main():
         args.method = method
         args.temp = temp
         args.use_gpu = use_gpu
+        args.preset = 'p4'
+        args.stream = stream
+        args.lowmem = lowmem
         
         print("\nStarting transcoding process with the following parameters:")
         print(f"Source: {args.source}")
-        print(f"Bitrate: {args.bitrate}")
+        if args.use_gpu:
+            print(f"Maximum GPU bitrate: {args.bitrate}")
         print(f"Destination: {args.dest_host}:{args.dest_folder}")
         print(f"Transfer method: {args.method}")
         print(f"Temp directory: {args.temp}")
@@ -415,17 +876,25 @@ def main():
         # Use command-line arguments as before
         parser = argparse.ArgumentParser(description="Transcode videos to H.264+AAC MKV and transfer to remote host")
         parser.add_argument("source", help="Source folder containing videos")
-        parser.add_argument("--bitrate", default="2M", help="Video bitrate (default: 2M)")
+        parser.add_argument("--bitrate", default="2M", help="Maximum video bitrate for GPU encoding (default: 2M)")
         parser.add_argument("dest_host", help="Destination host for file transfer")
         parser.add_argument("dest_folder", help="Destination folder on remote host")
         parser.add_argument("--username", help="Username for remote host")
         parser.add_argument("--password", help="Password for remote host")
-        parser.add_argument("--method", choices=["sftp", "scp"], default="sftp", 
-                          help="File transfer method (default: sftp)")
+        parser.add_argument("--method", choices=["scp", "sftp"], default="scp", 
+                          help="File transfer method (default: scp)")
         parser.add_argument("--temp", default="/tmp/transcode", 
                           help="Temporary folder for transcoded files")
         parser.add_argument("--gpu", action="store_true", 
                           help="Use NVIDIA GPU acceleration for transcoding")
+        parser.add_argument("--preset", choices=[f"p{n}" for n in range(1, 8)], default="p4",
+                          help="NVENC preset, p1 (fastest) to p7 (best quality) (default: p4)")
+        parser.add_argument("--lowmem", action="store_true",
+                          help="Reduce NVENC memory use (fewer surfaces, no lookahead or B-frames) for small GPUs")
+        parser.add_argument("--stream", action="store_true",
+                          help="Pipe transcoded videos straight to the remote host over ssh instead of "
+                               "writing them to the temp folder first. MKVs written to a pipe have no "
+                               "seek index (Cues) or duration, so players seek poorly in them")
         
         args = parser.parse_args()
         args.use_gpu = args.gpu if hasattr(args, 'gpu') else False
@@ -434,49 +903,49 @@ def main():
     temp_dir = Path(args.temp)
     temp_dir.mkdir(parents=True, exist_ok=True)
     
-    # Find all video files in source folder
-    video_files = find_video_files(args.source)
+    # Find all video files in source folder; the walk carries on lazily
+    # while the first file is transcoding
+    video_files = find_video_files(args.source, exclude_dir=temp_dir)
+    first_video = next(video_files, None)
     
-    if not video_files:
+    if first_video is None:
         print("No video files found in source folder.")
         return
+    video_files = itertools.chain([first_video], video_files)
     
-    print(f"Found {len(video_files)} video files to process.")
-    
-    
-    for i, video_path in enumerate(video_files, 1):
-        print(f"Processing file {i}/{len(video_files)}: {video_path}")
-        
-        # Create output filename preserving directory structure
-        rel_path = video_path.relative_to(Path(args.source))
-        output_dir = temp_dir / rel_path.parent
-        output_path = output_dir / rel_path.stem
-        output_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Transcode video
-        print(f"Transcoding {video_path}...")
-        transcode_video(video_path, output_path, args.bitrate, use_gpu=args.use_gpu)
-        
-        # Transfer MKV file with preserved directory structure
-        mkv_path = f"{output_path}.mkv"
-        remote_mkv_path = f"{args.dest_folder}/{rel_path.parent/rel_path.stem}.mkv"
-        print(f"Transferring {mkv_path} to {args.dest_host}:{remote_mkv_path}")
-        transfer_file(mkv_path, args.dest_host, remote_mkv_path, args.username, args.password, args.method)
-        
-        # Transfer SRT file if it exists
-        srt_path = f"{output_path}.srt"
-        if os.path.exists(srt_path):
-            remote_srt_path = f"{args.dest_folder}/{rel_path.parent/rel_path.stem}.srt"
-            print(f"Transferring {srt_path} to {args.dest_host}:{remote_srt_path}")
-            transfer_file(srt_path, args.dest_host, remote_srt_path, args.username, args.password, args.method)
+    with contextlib.ExitStack() as stack:
+        # Open the SFTP connection once and reuse it for every file
+        session = None
+        if args.method == 'sftp':
+            try:
+                session = stack.enter_context(RemoteSession(args.dest_host, args.username, args.password))
+            except Exception as e:
+                print(f"Could not open SFTP session: {e}")
+                print("Using SCP for all transfers instead...")
+                args.method = 'scp'
         
-        # Clean up temporary files
-        if os.path.exists(mkv_path):
-            os.remove(mkv_path)
-        if os.path.exists(srt_path):
-            os.remove(srt_path)
+        # Transcode and upload in parallel: the next file is transcoding while
+        # the previous one is on the wire
+        transfer_queue = queue.Queue(maxsize=2)
+        pending_srts = []
+        try:
+            with ThreadPoolExecutor(max_workers=TRANSFER_WORKERS) as transfer_pool:
+                transfers = [
+                    transfer_pool.submit(_transfer_worker, transfer_queue, args, pending_srts, session)
+                    for _ in range(TRANSFER_WORKERS)
+                ]
+                failures = _transcode_stage(video_files, args, temp_dir, transfer_queue)
+                for transfer in transfers:
+                    transfer.result()
+        finally:
+            # Subtitles are tiny, so send them together over one connection
+            if pending_srts:
+                _transfer_subtitles(pending_srts, args, temp_dir, session)
             
-    print("All files processed successfully!")
+    if failures:
+        print(f"Done, but {failures} file(s) failed to transcode.")
+    else:
+        print("All files processed successfully!")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file